@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# times the Schedule operations on synthetic schedules, no discord token or network needed:
+#   python bench.py --sizes 100,1000,10000 --output bench_results.json
+
+import argparse
+import atexit
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# bot.py changes into its own directory at import
+invoked_from = os.getcwd()
+# bot.py reads its config at import, the ids are never used because nothing connects
+workdir = tempfile.mkdtemp(prefix='eventbot-bench-')
+atexit.register(shutil.rmtree, workdir, True)
+for key, value in {
+    'BOT_TOKEN': 'bench', 'FB_TOKEN': '', 'CALENDAR_ID': 'bench', 'GUILD_ID': '0', 'UPCOMING_EVENTS': '0',
+    'NEW_EVENTS': '0', 'ADMIN_ROLE_ID': '0', 'ADMIN_ID': '0', 'MOD_ROLE_ID': '0', 'ORGANIZER_ROLE_ID': '0',
+}.items():
+    os.environ.setdefault(key, value)
+os.environ['EVENTS_DB'] = os.path.join(workdir, 'events.db')
+os.environ['FB_CACHE_DB'] = os.path.join(workdir, 'fb_cache.db')
+
+import bot
+from bot import Event, Schedule
+
+
+SIZES = [100, 1000, 10000, 50000]
+# spread over a season, with a handful of venues and recurring names so fuzzy matching has work to do
+DAYS = 90
+VENUES = ['The Pub', 'Jazz Cafe', 'Roundhouse', 'Union Chapel', 'The Lexington', 'Moth Club', 'Cafe Oto', 'EartH']
+CITIES = ['London', 'Brighton', 'Bristol', None]
+KINDS = ['Jazz Night', 'Open Mic', 'Rock Show', 'Quiz', 'Folk Session', 'Comedy Club', 'Vinyl Swap', 'Life Drawing']
+SUFFIXES = ['', ' at {venue}', ' vol. {n}', ' - {venue} special', ': {n} years', ' (sold out)']
+AUTHORS = [f'<@{1000 + i}>' for i in range(40)]
+
+
+def synthetic_events(count, rng):
+    today = datetime.date.today()
+    events = []
+    for i in range(count):
+        venue = rng.choice(VENUES)
+        name = rng.choice(KINDS) + rng.choice(SUFFIXES).format(venue=venue, n=rng.randint(1, 30))
+        events.append(Event.create(
+            name,
+            date=today + datetime.timedelta(days=rng.randrange(DAYS)),
+            time=datetime.time(rng.randint(17, 23), rng.choice([0, 15, 30, 45])),
+            location=venue,
+            city=rng.choice(CITIES),
+            discord_author=rng.choice(AUTHORS),
+            description=' '.join(rng.choice(KINDS).lower() for _ in range(rng.randint(0, 60))) or None,
+            fb_url=f'https://www.facebook.com/events/{rng.randrange(10**15)}/' if rng.random() < 0.4 else None,
+        ))
+    return events
+
+
+def synthetic_gcal_items(count, rng, offset=0):
+    now = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+    items = []
+    for i in range(count):
+        start = now + datetime.timedelta(days=rng.randrange(DAYS), hours=rng.randint(0, 6))
+        items.append({
+            'id': f'gcal{offset + i}',
+            'summary': rng.choice(KINDS) + rng.choice(SUFFIXES).format(venue=rng.choice(VENUES), n=rng.randint(1, 30)),
+            'start': {'dateTime': start.strftime('%Y-%m-%dT%H:%M:%S%z')},
+            'location': rng.choice(VENUES),
+            'creator': {'email': f'organizer{rng.randrange(20)}@example.com'},
+            'htmlLink': f'https://www.google.com/calendar/event?eid=gcal{offset + i}',
+            'description': rng.choice(KINDS),
+        })
+    return items
+
+
+def sorted_schedule(events):
+    return Schedule(sorted(events, key=lambda e: e.approx_datetime()))
+
+
+def cases(size, rng):
+    # name -> (ops per run, setup returning the argument, the timed call)
+    events = synthetic_events(size, rng)
+    kwargs = [dict(name=e.name, date=e.date, time=e.time, location=e.location, city=e.city,
+                   discord_author=e.author, description=e.description, fb_url=e.fb_url) for e in events]
+    gcal_items = synthetic_gcal_items(size, rng)
+    # half of them already known by gcal id, the other half new
+    gcal_merge = gcal_items[:size // 2] + synthetic_gcal_items(size - size // 2, rng, offset=size)
+    dumped = sorted_schedule(events).dump_json()
+
+    def populated():
+        schedule = sorted_schedule(synthetic_events(size, random.Random(size)))
+        return schedule.merge_gcal([Event.from_gcal_event(i) for i in gcal_items])
+
+    def fresh_render_cache():
+        bot.render_cache = bot.RenderCache()
+
+    def warm_schedule():
+        schedule = sorted_schedule(events)
+        fresh_render_cache()
+        schedule.format_post()
+        return schedule
+
+    def cold_schedule():
+        fresh_render_cache()
+        return sorted_schedule(events)
+
+    return {
+        'event_create': (size, lambda: kwargs, lambda ks: [Event.create(k.pop('name'), **k) for k in map(dict, ks)]),
+        'event_from_gcal': (size, lambda: gcal_items, lambda items: [Event.from_gcal_event(i) for i in items]),
+        'add_event': (size, lambda: (Schedule([]), [Event.from_dict(e.to_dict()) for e in events]),
+                      lambda a: [a[0].add_event(e) for e in a[1]]),
+        'merge_gcal': (size, lambda: (populated(), [Event.from_gcal_event(i) for i in gcal_merge]),
+                       lambda a: a[0].merge_gcal(a[1])),
+        'format_post_cold': (1, cold_schedule, lambda s: s.format_post()),
+        'format_post_warm': (1, warm_schedule, lambda s: s.format_post()),
+        'split_post': (size, lambda: [line + '\n' for e in events for line in e.summary()], lambda lines: Schedule([]).split_post(lines)),
+        'dump_json': (size, lambda: sorted_schedule(events), lambda s: s.dump_json()),
+        'parse_json': (size, lambda: dumped, lambda js: Schedule.parse_json(js)),
+    }
+
+
+def measure(ops, setup, fn, repeat, memory):
+    timings = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            arg = setup()
+            start = time.perf_counter()
+            fn(arg)
+            timings.append(time.perf_counter() - start)
+
+        peak = None
+        if memory:
+            arg = setup()
+            tracemalloc.start()
+            try:
+                fn(arg)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    best = min(timings)
+    return {
+        'ops': ops,
+        'seconds': best,
+        'seconds_all': timings,
+        'ops_per_sec': ops / best if best else None,
+        'peak_bytes': peak,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='benchmark Schedule operations on synthetic schedules')
+    arg_parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help='comma separated schedule sizes')
+    arg_parser.add_argument('--only', default=None, help='comma separated benchmark names')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark, the fastest is reported')
+    arg_parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--output', default='bench_results.json')
+    args = arg_parser.parse_args()
+
+    only = set(args.only.split(',')) if args.only else None
+    results = []
+    print(f"{'benchmark':<18} {'size':>7} {'seconds':>10} {'ops/sec':>12} {'peak MB':>9}")
+    for size in map(int, args.sizes.split(',')):
+        for name, (ops, setup, fn) in cases(size, random.Random(args.seed)).items():
+            if only is not None and name not in only:
+                continue
+            result = {'name': name, 'size': size, **measure(ops, setup, fn, args.repeat, not args.no_memory)}
+            results.append(result)
+            peak = f"{result['peak_bytes'] / 2**20:.1f}" if result['peak_bytes'] is not None else '-'
+            print(f"{name:<18} {size:>7} {result['seconds']:>10.4f} {result['ops_per_sec']:>12.0f} {peak:>9}")
+            sys.stdout.flush()
+
+    report = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(os.path.join(invoked_from, args.output), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,37 @@
 #!/usr/bin/env python3
 
+import time
+STARTED = time.monotonic()
+
+import asyncio
 import bisect
+import contextlib
 import datetime
+import hashlib
 from dateutil import parser
 import discord
 from discord import app_commands
 from discord.ext import tasks
 import pprint
-import urllib
+import urllib.parse
 import pytz
 import validators
 import sqlite3
+import traceback
+import uuid
+from dataclasses import dataclass, field, fields
 
-from fb import Fb, driver
+from fb import Fb, FbCache, FbException, DriverPool, GraphClient, PageScraper
 import io
 import json
-from collections import namedtuple
+from collections import deque, namedtuple, OrderedDict
 import os
 import sys
 import itertools
 from itertools import chain, groupby
-from rapidfuzz import fuzz
-
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
 import re
-import requests
+from concurrent.futures import ThreadPoolExecutor
 
 from typing import List, Optional
 from zoneinfo import ZoneInfo
@@ -45,27 +47,71 @@ ADMIN_ID=int(os.environ['ADMIN_ID'])
 MOD_ROLE_ID=int(os.environ['MOD_ROLE_ID'])
 ORGANIZER_ROLE_ID=int(os.environ['ORGANIZER_ROLE_ID'])
 CONTACT_SUBSTITUTIONS="substitutions.json"
+# sqlite files, relative to the bot's directory
+EVENTS_DB=os.environ.get('EVENTS_DB', 'events.db')
+FB_CACHE_DB=os.environ.get('FB_CACHE_DB', 'fb_cache.db')
+# write a full schedule snapshot into events_log every N logged changes, 0 disables
+CHECKPOINT_EVERY=int(os.environ.get('CHECKPOINT_EVERY', '100'))
+# headless chromes scraping fb events, how many more requests may wait for one, and how long a scrape may take
+FB_DRIVERS=int(os.environ.get('FB_DRIVERS', '1'))
+FB_QUEUE=int(os.environ.get('FB_QUEUE', '4'))
+FB_TIMEOUT=float(os.environ.get('FB_TIMEOUT', '60'))
+# chromes are restarted after this many pages or minutes, or when together they use more than FB_DRIVER_MEMORY MB, 0 disables a limit
+FB_DRIVER_PAGES=int(os.environ.get('FB_DRIVER_PAGES', '50'))
+FB_DRIVER_MINUTES=float(os.environ.get('FB_DRIVER_MINUTES', '60'))
+FB_DRIVER_MEMORY=int(os.environ.get('FB_DRIVER_MEMORY', '1024'))
+# only open the event page in chrome when the graph api response is missing something
+FB_GRAPH_FIRST=os.environ.get('FB_GRAPH_FIRST', '0') == '1'
+# scraped fb events are reused for FB_CACHE_TTL seconds, at most FB_CACHE_SIZE of them are kept
+FB_CACHE_TTL=float(os.environ.get('FB_CACHE_TTL', str(6 * 60 * 60)))
+FB_CACHE_SIZE=int(os.environ.get('FB_CACHE_SIZE', '500'))
+FB_HTTP_TIMEOUT=float(os.environ.get('FB_HTTP_TIMEOUT', '10'))
+FB_HTTP_RETRIES=int(os.environ.get('FB_HTTP_RETRIES', '3'))
+# read the event page over plain http first, chrome only when that comes back without the event
+FB_HTTP_SCRAPE=os.environ.get('FB_HTTP_SCRAPE', '1') == '1'
+# edits within PUBLISH_DEBOUNCE seconds are persisted and republished together, 0 publishes every edit right away
+PUBLISH_DEBOUNCE=float(os.environ.get('PUBLISH_DEBOUNCE', '10'))
 
 os.chdir(sys.path[0])
 
 substitutions = {}
-with open(CONTACT_SUBSTITUTIONS) as f:
-    try:
+try:
+    with open(CONTACT_SUBSTITUTIONS) as f:
         substitutions = json.loads(f.read())
-    except e:
-        print(e)
+except (OSError, ValueError) as e:
+    print(f'no contact substitutions loaded: {e}')
 
-db_con = sqlite3.connect("events.db")
+db_con = sqlite3.connect(EVENTS_DB)
 db_cur = db_con.cursor()
 db_cur.execute("CREATE TABLE IF NOT EXISTS events_log(id integer PRIMARY KEY, timestamp text DEFAULT CURRENT_TIMESTAMP, json TEXT, change TEXT)")
+db_cur.execute("CREATE TABLE IF NOT EXISTS events(uid text PRIMARY KEY, gcal_url text, fb_id text, date text, author text, data text)")
+db_cur.execute("CREATE INDEX IF NOT EXISTS events_date ON events(date)")
+db_cur.execute("CREATE INDEX IF NOT EXISTS events_author ON events(author)")
+db_cur.execute("CREATE INDEX IF NOT EXISTS events_gcal_url ON events(gcal_url)")
+db_cur.execute("CREATE INDEX IF NOT EXISTS events_fb_id ON events(fb_id)")
+# events_log used to hold a full json snapshot per change, now it's a delta log (event_id, op, changed fields)
+# with the json column only filled in for periodic checkpoints
+log_columns = [row[1] for row in db_cur.execute("PRAGMA table_info(events_log)").fetchall()]
+for column in ['event_id', 'op', 'fields']:
+    if column not in log_columns:
+        db_cur.execute(f"ALTER TABLE events_log ADD COLUMN {column} TEXT")
+db_cur.execute("CREATE TABLE IF NOT EXISTS gcal_events(id text PRIMARY KEY, start text, item text)")
+db_cur.execute("CREATE INDEX IF NOT EXISTS gcal_events_start ON gcal_events(start)")
+db_cur.execute("CREATE TABLE IF NOT EXISTS sync_state(key text PRIMARY KEY, value text)")
+db_cur.execute("CREATE TABLE IF NOT EXISTS schedule_messages(channel_id integer, position integer, message_id integer, kind text, digest text, PRIMARY KEY (channel_id, position))")
 
 tzinfo = ZoneInfo('Europe/London')
 
 class GCal:
     CALENDAR_ID = os.environ['CALENDAR_ID']
     SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+    DISCOVERY_CACHE = 'calendar_discovery.json'
+    # refresh the access token this long before it expires
+    REFRESH_MARGIN = datetime.timedelta(minutes=5)
 
     def __init__(self):
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
         creds = None
         # The file token.json stores the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first
@@ -73,57 +119,149 @@ class GCal:
         if os.path.exists('token.json'):
             creds = Credentials.from_authorized_user_file('token.json', GCal.SCOPES)
         # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
+        # Expired ones are refreshed by refresh_task once the bot is running.
+        if not creds or not (creds.valid or creds.refresh_token):
+            flow = InstalledAppFlow.from_client_secrets_file(
+                'credentials.json', GCal.SCOPES)
+            creds = flow.run_local_server(port=0)
+            self.save_credentials(creds)
+
+        self.creds = creds
+        self.service = None
+        self.refresher = None
+        # the google client's http objects aren't thread safe, so every call goes through one worker
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gcal')
+
+    def save_credentials(self, creds):
+        # Save the credentials for the next run
+        with open('token.json', 'w') as token:
+            token.write(creds.to_json())
+
+    def get_service(self):
+        # the discovery document is kept on disk so building the client doesn't need a request
+        if self.service is None:
+            from googleapiclient.discovery import build, build_from_document
+            if os.path.exists(GCal.DISCOVERY_CACHE):
+                with open(GCal.DISCOVERY_CACHE) as f:
+                    self.service = build_from_document(f.read(), credentials=self.creds)
             else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    'credentials.json', GCal.SCOPES)
-                creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open('token.json', 'w') as token:
-                token.write(creds.to_json())
-
-        self.service = build('calendar', 'v3', credentials=creds)
-
-    def fetch_events(self):
+                self.service = build('calendar', 'v3', credentials=self.creds)
+                with open(GCal.DISCOVERY_CACHE, 'w') as f:
+                    f.write(json.dumps(self.service._rootDesc))
+        return self.service
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def refresh_credentials(self):
+        from google.auth.transport.requests import Request
+        self.creds.refresh(Request())
+        self.save_credentials(self.creds)
+        print('refreshed gcal credentials')
+
+    def start(self):
+        if self.refresher is None or self.refresher.done():
+            self.refresher = asyncio.create_task(self.refresh_task())
+
+    async def refresh_task(self):
+        # an expired token is refreshed right away, after that at most once a minute
+        min_wait = 0
+        while True:
+            wait = 30 * 60
+            if self.creds.expiry is not None:
+                # google-auth keeps expiry as naive utc
+                wait = (self.creds.expiry - GCal.REFRESH_MARGIN - datetime.datetime.utcnow()).total_seconds()
+            await asyncio.sleep(max(wait, min_wait))
+            min_wait = 60
+            try:
+                await self.run(self.refresh_credentials)
+            except Exception as e:
+                print(traceback.format_exc())
+                print(f'refreshing gcal credentials failed: {e}')
+
+    def sync_events(self, sync_token: Optional[str]):
+        # with a sync token only items changed since the last call come back, cancelled ones included,
+        # without one it's a full listing of everything from now on
+        from googleapiclient.errors import HttpError
         try:
-            now = datetime.datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
-            week_later = (datetime.datetime.utcnow() + datetime.timedelta(days=7)).isoformat() + 'Z'
-            events_result = self.service.events().list(calendarId=GCal.CALENDAR_ID, timeMin=now,
-                                                timeMax=week_later, singleEvents=True,
-                                                orderBy='startTime').execute()
-            events = events_result.get('items', [])
-
-            if not events:
-                print('No upcoming events found.')
-                return []
-
-            print('fetched events')
-            return events
+            items = []
+            page_token = None
+            full_sync = sync_token is None
+            while True:
+                args = {'calendarId': GCal.CALENDAR_ID, 'singleEvents': True, 'pageToken': page_token}
+                if full_sync:
+                    args['timeMin'] = datetime.datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
+                else:
+                    args['syncToken'] = sync_token
+                try:
+                    events_result = self.get_service().events().list(**args).execute()
+                except HttpError as error:
+                    if error.resp.status == 410 and not full_sync:
+                        print('gcal sync token expired, doing a full sync')
+                        items, page_token, full_sync = [], None, True
+                        continue
+                    raise
+                items.extend(events_result.get('items', []))
+                page_token = events_result.get('nextPageToken')
+                if not page_token:
+                    break
+
+            print(f'fetched {len(items)} changed events')
+            return items, events_result.get('nextSyncToken'), full_sync
 
         except HttpError as error:
             print(f'An error occured: {str(error)}')
 
 
 def json_default(o):
-    if isinstance(o, (datetime.date, datetime.datetime)):
+    if isinstance(o, (datetime.date, datetime.datetime, datetime.time)):
         return o.isoformat()
 
+@dataclass(slots=True, eq=False)
 class Event:
-    def __init__(self, **kwargs):
-        filtered = {k: v for k, v in kwargs.items() if v is not None}
-        self.datetime = None
-        self._date = None
-        self._time = None
-        self.author = None
-        self.__dict__.update(filtered)
+    # annotations are strings, the datetime field shadows the module inside the class body
+    name: 'Optional[str]' = None
+    description: 'Optional[str]' = None
+    datetime: 'Optional[datetime.datetime]' = None
+    _date: 'Optional[datetime.date]' = None
+    _time: 'Optional[datetime.time]' = None
+    author: 'Optional[str]' = None
+    email: 'Optional[str]' = None
+    url: 'Optional[str]' = None
+    fb_url: 'Optional[str]' = None
+    gcal_url: 'Optional[str]' = None
+    gcal_id: 'Optional[str]' = None
+    # fb event id
+    id: 'Optional[str]' = None
+    hydrated: 'Optional[bool]' = None
+    img: 'Optional[str]' = None
+    location: 'Optional[str]' = None
+    city: 'Optional[str]' = None
+    source: 'Optional[str]' = None
+    deleted: 'Optional[bool]' = None
+    uid: 'Optional[str]' = None
+    _approx_datetime: 'Optional[datetime.datetime]' = field(default=None, init=False, repr=False)
+
+    # always part of to_dict and merge, even when unset
+    ALWAYS_SET = ('datetime', '_date', '_time', 'author', 'uid')
+
+    def __post_init__(self):
+        if self.uid is None:
+            self.uid = uuid.uuid4().hex
         if isinstance(self.datetime, str):
             self.datetime = datetime.datetime.fromisoformat(self.datetime)
         if isinstance(self._date, str):
             self._date = parser.parse(self._date).date()
         if isinstance(self._time, str):
             self._time = parser.parse(self._time).time()
+        self._approx_datetime = self.compute_approx_datetime()
+
+    @classmethod
+    def from_dict(cls, dct):
+        # older snapshots could carry keys that aren't fields anymore
+        known = {f.name for f in fields(cls) if f.init}
+        return cls(**{k: v for k, v in dct.items() if k in known})
 
     @classmethod
     def create(cls, name, **kwargs):
@@ -141,6 +279,7 @@ class Event:
                 d['_date'] = datetime.date.today() + datetime.timedelta(days=days_until)
         d['fb_url'] = kwargs.get('fb_url', None)
         d['gcal_url'] = kwargs.get('gcal_url', None)
+        d['gcal_id'] = kwargs.get('gcal_id', None)
         d['email'] = kwargs.get('email', None)
         d['author'] = kwargs.get('discord_author', None)
         d['img'] = kwargs.get('img', None)
@@ -153,22 +292,18 @@ class Event:
 
     @property
     def date(self):
-        try:
-            if self.datetime is not None:
-                return self.datetime.date()
-            elif self._date is not None:
-                return self._date
-            else:
-                return None
-        except AttributeError:
-            print(vars(self))
-            raise
+        if self.datetime is not None:
+            return self.datetime.date()
+        elif self._date is not None:
+            return self._date
+        else:
+            return None
 
     # @date.setter
     # def date(self, value):
     #     raise Exception('setting date')
 
-    def approx_datetime(self):
+    def compute_approx_datetime(self):
         if self.datetime:
             if self.time:
                 return datetime.datetime.combine(self.datetime.date(), self.time, tzinfo=tzinfo)
@@ -181,20 +316,30 @@ class Event:
             else:
                 return tz.localize(dtime)
         else:
+            return None
+
+    def approx_datetime(self):
+        if self._approx_datetime is None:
             raise Exception(f'event {self.name} does not have a valid date')
+        return self._approx_datetime
 
     def delete(self):
         self.deleted = True
         return self
 
     def active(self):
-        try:
-            return not self.deleted
-        except AttributeError:
-            return True
+        return not self.deleted
+
+    def content_key(self):
+        # everything that ends up in a rendered embed or summary line
+        return tuple(getattr(self, f) for f in Event.MERGED_FIELDS)
     
     def merge(self, event):
-        self.__dict__.update(event.__dict__)
+        for f in Event.MERGED_FIELDS:
+            value = getattr(event, f)
+            if value is not None or f in Event.ALWAYS_SET:
+                setattr(self, f, value)
+        self._approx_datetime = self.compute_approx_datetime()
     
     @property
     def time(self):
@@ -239,16 +384,20 @@ class Event:
     @classmethod
     def from_gcal_event(cls, gcal_event):
         summary = gcal_event['summary']
-        dtim = gcal_event['start']['dateTime']
-        datetime_parsed = datetime.datetime.strptime(dtim, "%Y-%m-%dT%H:%M:%S%z")
-        location = gcal_event['location']
+        dtim = gcal_event['start'].get('dateTime', None)
+        datetime_parsed = datetime.datetime.strptime(dtim, "%Y-%m-%dT%H:%M:%S%z") if dtim else None
+        # all day events only have a date
+        date = datetime.date.fromisoformat(gcal_event['start']['date']) if not dtim else None
+        location = gcal_event.get('location', None)
         author = gcal_event['creator']['email']
         url = gcal_event['htmlLink']
         description = gcal_event.get('description', None)
 
         args = {
             'gcal_url': url,
+            'gcal_id': gcal_event['id'],
             'datetime': datetime_parsed,
+            'date': date,
             'location': location,
             'email': author,
             'description': description,
@@ -260,7 +409,11 @@ class Event:
         return ev
 
     def to_dict(self):
-        dct = vars(self)
+        dct = {}
+        for f in Event.SERIALIZED_FIELDS:
+            value = getattr(self, f)
+            if value is not None or f in Event.ALWAYS_SET:
+                dct[f] = value
         # if '_date' in dct:
         #     dct['date'] = dct['_date']
         #     del dct['_date']
@@ -272,55 +425,33 @@ class Event:
     def selector_value(self):
         d = self.date
         if not d:
-            print(vars(self))
+            print(self)
         return " - ".join([self.date.isoformat(), self.name[:80]])
 
     def pretty(self):
         assert self.active, f"{self.name} is deleted"
 
-        organizer = None
-        try:
-            organizer = self.author if self.author else self.email
-        except AttributeError:
-            pass
-
-        if organizer is not None and not organizer.startswith('<'):
-            try:
-                sub = substitutions[organizer]
-                organizer = f'[ORGANIZER]({sub})'
-            except:
-                pass
+        organizer = self.author if self.author else self.email
+        if organizer is not None and not organizer.startswith('<') and organizer in substitutions:
+            organizer = f'[ORGANIZER]({substitutions[organizer]})'
         
         url = None
-        try:
-            if hasattr(self, 'url'):
-                url = f'[LINK]({self.url}'
-            if hasattr(self, 'fb_url'):
-                url = f'[FB]({self.fb_url})'
-        except AttributeError:
-            pass
+        if self.url is not None:
+            url = f'[LINK]({self.url})'
+        if self.fb_url is not None:
+            url = f'[FB]({self.fb_url})'
         
         location = None
-        try:
-            loc = self.location
-            loc = urllib.parse.quote(loc)
-            gmaps_link = 'https://www.google.com/maps/search/?api=1&query=' + loc
+        if self.location is not None:
+            gmaps_link = 'https://www.google.com/maps/search/?api=1&query=' + urllib.parse.quote(self.location)
             location = f'[{self.location}]({gmaps_link})'
-        except AttributeError:
-            pass
 
         description = None
-        try:
+        if self.description is not None:
             desc = self.description.replace('<br>', '\n').replace('<br />', '\n')
             description = '```' + desc[0:250] + '```'
-        except AttributeError:
-            pass
 
-        time = None
-        try:
-            time = str(self.time) if self.time else 'NO TIME'
-        except AttributeError:
-            pass
+        time = str(self.time) if self.time else 'NO TIME'
         
         summary = " - ".join([p for p in [time, self.name, url, organizer, location] if p is not None])
         return [p for p in [summary, description] if p is not None]
@@ -328,42 +459,22 @@ class Event:
     def summary(self):
         assert self.active, f"{self.name} is deleted"
 
-        organizer = None
-        try:
-            organizer = self.author if self.author else self.email
-        except AttributeError:
-            pass
-
-        if organizer is not None and not organizer.startswith('<'):
-            try:
-                sub = substitutions[organizer]
-                organizer = f'[ORGANIZER]({sub})'
-            except:
-                pass
+        organizer = self.author if self.author else self.email
+        if organizer is not None and not organizer.startswith('<') and organizer in substitutions:
+            organizer = f'[ORGANIZER]({substitutions[organizer]})'
         
         url = None
-        try:
-            if hasattr(self, 'url'):
-                url = f'[LINK]({self.url}'
-            if hasattr(self, 'fb_url'):
-                url = f'[FB]({self.fb_url})'
-        except AttributeError:
-            pass
+        if self.url is not None:
+            url = f'[LINK]({self.url})'
+        if self.fb_url is not None:
+            url = f'[FB]({self.fb_url})'
         
         location = None
-        try:
-            loc = self.location
-            loc = urllib.parse.quote(loc)
-            gmaps_link = 'https://www.google.com/maps/search/?api=1&query=' + loc
+        if self.location is not None:
+            gmaps_link = 'https://www.google.com/maps/search/?api=1&query=' + urllib.parse.quote(self.location)
             location = f"[{self.location.split(',')[0]}]({gmaps_link})"
-        except AttributeError:
-            pass
 
-        time = None
-        try:
-            time = str(self.time) if self.time else 'NO TIME'
-        except AttributeError:
-            pass
+        time = str(self.time) if self.time else 'NO TIME'
         
         summary = " - ".join([p for p in [time, self.name, url, organizer, location] if p is not None])
         return [summary]
@@ -371,28 +482,19 @@ class Event:
 
     def make_embed(self, description_limit=4096) -> discord.Embed:
         description = ''
-        try:
+        if self.description is not None:
             description = self.description[0:description_limit].replace('<br>', '\n').replace('<br />', '\n')
-        except AttributeError:
-            pass
-        embed = discord.Embed(title=self.name, description=description, url=getattr(self, 'fb_url', None))
-        if hasattr(self, 'img'):
+        embed = discord.Embed(title=self.name, description=description, url=self.fb_url)
+        if self.img is not None:
             embed.set_image(url=self.img)
-        organizer = None
-        try:
-            organizer = self.author if self.author else self.email
-            if organizer is not None and not organizer.startswith('<'):
-                try:
-                    sub = substitutions[organizer]
-                    organizer = sub
-                except:
-                    pass
+        organizer = self.author if self.author else self.email
+        if organizer is not None:
+            if not organizer.startswith('<'):
+                organizer = substitutions.get(organizer, organizer)
             embed.set_author(name=organizer, url=organizer if validators.url(organizer) else None)
-        except AttributeError:
-            pass
-        location = getattr(self, 'location', '').split(',')[0]
+        location = (self.location or '').split(',')[0]
         embed.add_field(name='Venue', value=location, inline=True)
-        city = getattr(self, 'city', '')
+        city = self.city or ''
         embed.add_field(name='City', value=city, inline=True)
         embed.add_field(name='Time', value=self.approx_datetime().strftime('%a, %d %b %Y, %H:%M'), inline=True)
         return embed
@@ -422,6 +524,9 @@ class Event:
 
         return None if not errors else errors
 
+Event.SERIALIZED_FIELDS = tuple(f.name for f in fields(Event) if f.init)
+Event.MERGED_FIELDS = tuple(f for f in Event.SERIALIZED_FIELDS if f != 'uid')
+
 # class GoogleEvent(Event):
 #     def __init__(self, name, date, url, author):
 #         super().__init__(name, date, url, author)
@@ -462,110 +567,346 @@ async def date_autocomplete(
     autocompleted_dates = dates(current)
     return autocompleted_dates
 
+# query parameters that only track where a link was shared from
+TRACKING_PARAMS = {'fbclid', 'ref', 'acontext', 'aref', 'mibextid', 'paipv', 'eav', 'sfnsn', 'locale'}
+
+def normalize_url(url: str):
+    parts = urllib.parse.urlsplit(url.strip())
+    host = parts.netloc.lower().removeprefix('www.').removeprefix('m.')
+    query = sorted((k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k not in TRACKING_PARAMS and not k.startswith('utm_'))
+    normalized = host + parts.path.rstrip('/')
+    return normalized + '?' + urllib.parse.urlencode(query) if query else normalized
+
+class RenderCache:
+    # rendered embeds and summaries by event content, so unchanged events aren't rendered again on every change
+    def __init__(self, max_entries=2000):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        value = render()
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+    def embed(self, event: Event, description_limit=4096):
+        return self.get(('embed', event.content_key(), description_limit), lambda: event.make_embed(description_limit=description_limit))
+
+    def summary(self, event: Event):
+        return self.get(('summary', event.content_key()), event.summary)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self.entries)
+        }
+
+render_cache = RenderCache()
+
 def eventDecoder(dct):
-    return Event(**dct)
+    return Event.from_dict(dct)
+
+fuzz = process = utils = None
+
+def load_rapidfuzz():
+    # imported on the first schedule rather than at startup
+    global fuzz, process, utils
+    if process is None:
+        from rapidfuzz import fuzz, process, utils
 
 class Schedule:
+    # token_set_ratio above which a new event is merged into an existing one on the same date
+    DUPLICATE_SCORE = 75.0
+    # events at the same venue starting at most this far apart are the same event
+    VENUE_TIME_WINDOW = datetime.timedelta(minutes=30)
+    # ...as long as their names are at least this close or they have the same organizer
+    VENUE_NAME_SCORE = 55.0
+    # discord limits per message
+    MESSAGE_LIMIT = 2000
+    EMBEDS_PER_MESSAGE = 10
+    EMBED_CHARS_PER_MESSAGE = 6000
+
     def __init__(self, events: List[Event]):
+        load_rapidfuzz()
+        # (op, event, changed fields) since the last persist
+        self.changes = []
+        self.reindex(events)
+
+    def reindex(self, events: List[Event]):
         self.events = events
+        # date -> (events, their normalized names) for duplicate detection
+        self.by_date = {}
+        # stable identity (gcal id, fb id, url) -> event
+        self.by_key = {}
+        # (venue, date) -> events there that have a start time
+        self.by_venue = {}
+        for e in events:
+            self.index(e)
+
+    @staticmethod
+    def identity_keys(event: Event):
+        keys = []
+        if event.gcal_id:
+            keys.append(('gcal', event.gcal_id))
+        fb_id = event.id
+        if fb_id is None and event.fb_url:
+            fb_id_match = re.search(r"facebook\.com/events/(\d+)", event.fb_url)
+            fb_id = fb_id_match.group(1) if fb_id_match else None
+        if fb_id is not None:
+            keys.append(('fb', str(fb_id)))
+        for url in [event.gcal_url, event.fb_url, event.url]:
+            if url:
+                keys.append(('url', normalize_url(url)))
+        return keys
+
+    @staticmethod
+    def venue_key(event: Event):
+        location = event.location
+        if not location or event.time is None:
+            return None
+        return (utils.default_process(location), event.date)
+
+    def index(self, event: Event):
+        events, names = self.by_date.setdefault(event.date, ([], []))
+        events.append(event)
+        names.append(utils.default_process(event.name))
+        for key in Schedule.identity_keys(event):
+            self.by_key.setdefault(key, event)
+        venue = Schedule.venue_key(event)
+        if venue is not None:
+            self.by_venue.setdefault(venue, []).append(event)
+
+    def unindex(self, event: Event):
+        events, names = self.by_date[event.date]
+        i = next(i for i, e in enumerate(events) if e is event)
+        del events[i]
+        del names[i]
+        if not events:
+            del self.by_date[event.date]
+        for key in Schedule.identity_keys(event):
+            if self.by_key.get(key) is event:
+                del self.by_key[key]
+        venue = Schedule.venue_key(event)
+        if venue is not None:
+            at_venue = self.by_venue[venue]
+            at_venue[:] = [e for e in at_venue if e is not event]
+            if not at_venue:
+                del self.by_venue[venue]
+
+    def find_match(self, event: Event):
+        # stable ids first, then the same venue at about the same time, fuzzy names as a last resort
+        for key in Schedule.identity_keys(event):
+            if key in self.by_key:
+                return self.by_key[key]
+        venue = Schedule.venue_key(event)
+        if venue is not None:
+            start = event.approx_datetime()
+            for e in self.by_venue.get(venue, []):
+                if abs(e.approx_datetime() - start) <= Schedule.VENUE_TIME_WINDOW and Schedule.same_venue_event(e, event):
+                    return e
+        return self.find_duplicate(event)
+
+    @staticmethod
+    def same_venue_event(existing: Event, event: Event):
+        # two different events can share a venue and a time slot (upstairs/downstairs rooms)
+        if existing.author is not None and existing.author == event.author:
+            return True
+        if existing.email is not None and existing.email == event.email:
+            return True
+        score = fuzz.token_set_ratio(utils.default_process(existing.name), utils.default_process(event.name))
+        return score >= Schedule.VENUE_NAME_SCORE
+
+    def find_duplicate(self, event: Event):
+        events, names = self.by_date.get(event.date, ([], []))
+        if not events:
+            return None
+        match = process.extractOne(utils.default_process(event.name), names, scorer=fuzz.token_set_ratio,
+                                   processor=None, score_cutoff=Schedule.DUPLICATE_SCORE)
+        if match is None or match[1] <= Schedule.DUPLICATE_SCORE:
+            return None
+        return events[match[2]]
 
     @classmethod
     async def parse_msg(cls, msg: discord.Message):
-        res = db_cur.execute("SELECT json FROM events_log ORDER BY id DESC LIMIT 1")
-        row = res.fetchone()
-        if row is None:
-            return cls([])
-        else:
-            return cls(Schedule.parse_json(row[0]))
+        migrate_snapshot()
+        res = db_cur.execute("SELECT data FROM events")
+        events = [eventDecoder(json.loads(row[0])) for row in res.fetchall()]
+        events.sort(key=lambda e: e.approx_datetime())
+        return cls(events)
     
     def parse_json(jsonBytes):
         return json.loads(jsonBytes, object_hook=eventDecoder)
 
     def add_event(self, event: Event):
-        potentially_duplicate_events = list(filter(lambda x: event.date == x.date, self.events))
-        duplicate_score = list(map(lambda x: (fuzz.token_set_ratio(x.name, event.name), x), potentially_duplicate_events))
-        likely_duplicate = list(filter(lambda x: x[0] > 75.0 , sorted(duplicate_score, key=lambda x: x[0])))
-        if likely_duplicate:
-            duplicate_name = (likely_duplicate[0][1]).name
-            index = [i for i, item in enumerate(self.events) if item.name == duplicate_name][0]
-            print(f'merging new event {event.name} into {duplicate_name}')
-            self.events[index].merge(event)
+        duplicate = self.find_match(event)
+        if duplicate is not None:
+            duplicate_name = duplicate.name
+            if self.update_event(duplicate, event):
+                print(f'merging new event {event.name} into {duplicate_name}')
         else:
             bisect.insort(self.events, event, key=lambda e: e.approx_datetime())
+            self.index(event)
+            self.changes.append(('add', event, event.to_dict()))
         return self
 
+    def update_event(self, target: Event, event: Event):
+        before = dict(target.to_dict())
+        self.unindex(target)
+        target.merge(event)
+        self.index(target)
+        changed = {k: v for k, v in target.to_dict().items() if before.get(k) != v}
+        if changed:
+            self.changes.append(('update', target, changed))
+            if changed.keys() & {'datetime', '_date', '_time'}:
+                self.events.remove(target)
+                bisect.insort(self.events, target, key=lambda e: e.approx_datetime())
+        return changed
+
     def remove_event(self, event_value: str):
         for idx, e in enumerate(self.events):
             if e.selector_value() in event_value:
                 del self.events[idx]
+                self.unindex(e)
+                self.changes.append(('delete', e, None))
                 break
         return self
 
+    def clear(self):
+        self.reindex([])
+        self.changes.append(('clear', None, None))
+        return self
+
     def dump_json(self):
         return json.dumps([e.to_dict() for e in self.events], default=json_default)
 
-    def merge_gcal(self, gcal_events):
-        # should also update existing events in case details changed, sth for later
-        existing_gcal_urls = [e.gcal_url for e in self.events if hasattr(e, 'gcal_url')]
-        new_events = [e for e in gcal_events if e.gcal_url not in existing_gcal_urls]
-
-        for e in new_events:
+    def merge_gcal(self, gcal_events, cancelled_ids=(), changed_events=()):
+        # gcal_events: the calendar items in the upcoming window, added or merged
+        # changed_events: every item changed since the last sync, only applied to events already known,
+        # so an event moved out of the window is moved here too
+        cancelled = [self.by_key[('gcal', i)] for i in cancelled_ids if ('gcal', i) in self.by_key]
+        for e in cancelled:
+            self.events.remove(e)
+            self.unindex(e)
+            self.changes.append(('delete', e, None))
+
+        for e in changed_events:
+            target = self.by_key.get(('gcal', e.gcal_id))
+            if target is not None:
+                self.update_event(target, e)
+
+        # add_event matches calendar items to existing events by gcal id or link before anything else
+        for e in gcal_events:
             self.add_event(e)
 
         return self
 
+    @staticmethod
+    def split_string(string: str, max_length: int):
+        # a single piece too long for one message is cut at the last newline or space that fits
+        while len(string) > max_length:
+            cut = string.rfind('\n', 0, max_length)
+            if cut <= 0:
+                cut = string.rfind(' ', 0, max_length)
+            if cut <= 0:
+                yield string[:max_length]
+                string = string[max_length:]
+            else:
+                yield string[:cut]
+                string = string[cut + 1:]
+        if string:
+            yield string
+
     def split_post(self, post):
-        max_length = 2000
+        max_length = Schedule.MESSAGE_LIMIT
         result = []
-        current_string = ""
+        buffer = []
+        length = 0
 
-        for string in post:
-            if len(current_string + string) < max_length:
-                current_string += string
-            else:
-                result.append(current_string)
-                current_string = string
+        for piece in post:
+            for string in Schedule.split_string(piece, max_length):
+                if buffer and length + len(string) > max_length:
+                    result.append(''.join(buffer))
+                    buffer = []
+                    length = 0
+                buffer.append(string)
+                length += len(string)
 
-        if current_string:
-            result.append(current_string)
+        if buffer:
+            result.append(''.join(buffer))
 
         return result
 
+    def pack_embeds(self, content: str, embeds: List[discord.Embed]):
+        # as few messages as possible, each within discord's embed count and total embed size limits
+        messages = []
+        current = []
+        size = 0
+        for embed in embeds:
+            embed_size = len(embed)
+            if current and (len(current) == Schedule.EMBEDS_PER_MESSAGE or size + embed_size > Schedule.EMBED_CHARS_PER_MESSAGE):
+                messages.append(current)
+                current = []
+                size = 0
+            current.append(embed)
+            size += embed_size
+        messages.append(current)
+
+        return [(content if i == 0 else '', chunk) for i, chunk in enumerate(messages)]
+
     def cleanup(self):
-        self.events = [e for e in self.events if e.date >= datetime.date.today()]
+        today = datetime.date.today()
+        for e in self.events:
+            if e.date < today:
+                self.unindex(e)
+                self.changes.append(('delete', e, None))
+        self.events = [e for e in self.events if e.date >= today]
         return self
 
-    def format_post(self):
+    def format_post(self, embed_days: Optional[int]=None, horizon_days: Optional[int]=None):
+        # embed_days: days from today that get a section of embeds each, by default the rest of this week
+        # horizon_days: days from today listed at all, by default everything
         embed_posts = []
         posts = []
 
-        active_events = list(filter(lambda x: x.active(), self.events))
-
         today = datetime.date.today()
-        d = lambda x: today + datetime.timedelta(days=x)
-        dates_in_this_week = []
-        if today.isoweekday() == 1:
-            dates_in_this_week = list(itertools.islice(map(d, itertools.count(0)), 7))
-        else:
-            dates_in_this_week = list(itertools.takewhile(lambda x: x.isoweekday() != 1, map(d, itertools.count(0))))
-
-        for date in dates_in_this_week:
-            date_events = list(filter(lambda x: x.date == date, active_events))
-
-            embeds = list(map(lambda x: x.make_embed(description_limit=250), date_events))
+        if embed_days is None:
+            embed_days = 7 if today.isoweekday() == 1 else 8 - today.isoweekday()
+        last_embed_date = today + datetime.timedelta(days=embed_days - 1)
+        end_date = today + datetime.timedelta(days=horizon_days) if horizon_days is not None else None
+
+        # one pass over the events, already sorted so this is linear
+        embed_dates = {today + datetime.timedelta(days=x): [] for x in range(embed_days)}
+        later_events = []
+        for e in sorted(filter(lambda x: x.active(), self.events), key=lambda x: x.approx_datetime()):
+            date = e.date
+            if date in embed_dates:
+                embed_dates[date].append(e)
+            elif date > last_embed_date and (end_date is None or date < end_date):
+                later_events.append(e)
+
+        for date, date_events in embed_dates.items():
+            embeds = list(map(lambda x: render_cache.embed(x, description_limit=250), date_events))
 
             msg_content = f"**======== {date.strftime('%A, %B %e')} =======**"
-            embed_posts.append((msg_content, embeds))
-        
-        last_embed_date = dates_in_this_week[-1]
-        later_events = list(filter(lambda x: x.date > last_embed_date, active_events))
+            embed_posts.extend(self.pack_embeds(msg_content, embeds))
 
         for d, evs in groupby(later_events, lambda x: x.date):
             day = []
             day.append(f"**======= {d.strftime('%A, %B %e')} =======**")
             day.append('\n')
             for e in evs:
-                day.extend(e.summary())
+                day.extend(render_cache.summary(e))
                 day.append('\n')
             posts.append(day)
 
@@ -602,73 +943,454 @@ class Schedule:
 
         return (embed_posts, list(chain.from_iterable(map(self.split_post, posts))))
 
+def event_row(e: Event):
+    date = e.date.isoformat() if e.date else None
+    author = e.author if e.author else e.email
+    return (e.uid, e.gcal_url, e.id, date, author, json.dumps(e.to_dict(), default=json_default))
+
+def migrate_snapshot():
+    # databases written before the events table only have full json snapshots in events_log
+    res = db_cur.execute("SELECT 1 FROM events_log WHERE op IS NOT NULL LIMIT 1")
+    if res.fetchone() is not None:
+        return
+    res = db_cur.execute("SELECT json FROM events_log WHERE json IS NOT NULL ORDER BY id DESC LIMIT 1")
+    row = res.fetchone()
+    events = Schedule.parse_json(row[0]) if row is not None else []
+    print(f'migrating {len(events)} events from the latest events_log snapshot')
+    db_cur.execute("DELETE FROM events")
+    db_cur.executemany("INSERT INTO events(uid, gcal_url, fb_id, date, author, data) VALUES(?, ?, ?, ?, ?, ?);", [event_row(e) for e in events])
+    db_cur.execute("INSERT INTO events_log(json, change, op) VALUES(?, ?, ?);", (json.dumps([e.to_dict() for e in events], default=json_default), 'migration', 'checkpoint'))
+    db_con.commit()
+
+def persist_changes(schedule: Schedule, changes, change_reason: Optional[str]=None):
+    reason = change_reason if change_reason else ''
+    log = []
+    for op, event, changed in changes:
+        if op == 'clear':
+            db_cur.execute("DELETE FROM events")
+            log.append((reason, None, op, None))
+        elif op == 'delete':
+            db_cur.execute("DELETE FROM events WHERE uid = ?", (event.uid,))
+            log.append((reason, event.uid, op, None))
+        else:
+            db_cur.execute("INSERT OR REPLACE INTO events(uid, gcal_url, fb_id, date, author, data) VALUES(?, ?, ?, ?, ?, ?);", event_row(event))
+            log.append((reason, event.uid, op, json.dumps(changed, default=json_default)))
+    db_cur.executemany("INSERT INTO events_log(change, event_id, op, fields) VALUES(?, ?, ?, ?);", log)
+
+    if CHECKPOINT_EVERY:
+        res = db_cur.execute("SELECT COUNT(*) FROM events_log WHERE id > (SELECT COALESCE(MAX(id), 0) FROM events_log WHERE op = 'checkpoint')")
+        if res.fetchone()[0] >= CHECKPOINT_EVERY:
+            db_cur.execute("INSERT INTO events_log(json, change, op) VALUES(?, ?, ?);", (schedule.dump_json(), reason, 'checkpoint'))
+
+def gcal_start(item):
+    start = item['start']
+    if 'dateTime' in start:
+        return datetime.datetime.fromisoformat(start['dateTime']).astimezone(datetime.timezone.utc).isoformat()
+    return start['date']
+
+def store_gcal_changes(items, sync_token: Optional[str], full_sync: bool):
+    # gcal_events mirrors the calendar from now on, so events that enter the
+    # week window later don't need to be fetched again
+    if full_sync:
+        db_cur.execute("DELETE FROM gcal_events")
+    for item in items:
+        if item.get('status') == 'cancelled':
+            db_cur.execute("DELETE FROM gcal_events WHERE id = ?", (item['id'],))
+        else:
+            db_cur.execute("INSERT OR REPLACE INTO gcal_events(id, start, item) VALUES(?, ?, ?);", (item['id'], gcal_start(item), json.dumps(item)))
+    now = datetime.datetime.now(datetime.timezone.utc)
+    db_cur.execute("DELETE FROM gcal_events WHERE start < ?", (now.date().isoformat(),))
+    db_cur.execute("INSERT OR REPLACE INTO sync_state(key, value) VALUES('gcal_sync_token', ?);", (sync_token,))
+    db_con.commit()
+
+def gcal_cancelled_ids(items, full_sync: bool):
+    cancelled_ids = [item['id'] for item in items if item.get('status') == 'cancelled']
+    if full_sync:
+        # without a token we don't get cancellations, anything missing from the full listing is gone
+        listed = {item['id'] for item in items}
+        cancelled_ids += [row[0] for row in db_cur.execute("SELECT id FROM gcal_events").fetchall() if row[0] not in listed]
+    return cancelled_ids
+
+def load_gcal_sync_token():
+    row = db_cur.execute("SELECT value FROM sync_state WHERE key = 'gcal_sync_token'").fetchone()
+    return row[0] if row else None
+
+def parse_gcal_items(items):
+    events = []
+    for item in items:
+        if item.get('status') == 'cancelled':
+            continue
+        try:
+            events.append(Event.from_gcal_event(item))
+        except (KeyError, TypeError, ValueError) as e:
+            # untitled events come without a summary
+            print(f'skipping gcal item {item.get("id")}: {e!r}')
+    return events
+
+def gcal_upcoming_events(days: int=7, pending=(), full_sync: bool=False):
+    # pending: items from a sync that isn't stored yet, they replace the stored rows with the same id
+    now = datetime.datetime.now(datetime.timezone.utc)
+    week_later = now + datetime.timedelta(days=days)
+    stored = []
+    if not full_sync:
+        res = db_cur.execute("SELECT item FROM gcal_events WHERE start >= ? AND start < ?", (now.isoformat(), week_later.isoformat()))
+        stored = [json.loads(row[0]) for row in res.fetchall()]
+    pending_ids = {item['id'] for item in pending}
+    items = [item for item in stored if item['id'] not in pending_ids]
+    items += [item for item in pending if item.get('status') != 'cancelled' and now.isoformat() <= gcal_start(item) < week_later.isoformat()]
+    items.sort(key=gcal_start)
+    return parse_gcal_items(items)
+
+async def sync_gcal(change_reason: str, cleanup: bool=False):
+    # the sync token is only stored once the schedule changes it brought in are saved,
+    # until then google keeps sending the same changes
+    gcal = await get_gcal()
+    changes = await gcal.run(gcal.sync_events, load_gcal_sync_token())
+    items, sync_token, full_sync = changes if changes is not None else ([], None, False)
+    async with schedule_cache.edit(change_reason=change_reason) as schedule:
+        if cleanup:
+            schedule.cleanup()
+        schedule.merge_gcal(gcal_upcoming_events(pending=items, full_sync=full_sync),
+                            gcal_cancelled_ids(items, full_sync), parse_gcal_items(items))
+    if changes is not None:
+        await schedule_cache.flush()
+        if schedule_cache.stale:
+            print('schedule changes from gcal were not saved, keeping the old sync token')
+        else:
+            store_gcal_changes(items, sync_token, full_sync)
+    return schedule
+
+class ScheduleCache:
+    # the schedule is loaded once and edited in place under the lock, changes are
+    # written to events.db by a background task so commands don't wait on sqlite
+    # a failed write is retried this many times, then the schedule is reloaded from what was saved
+    WRITE_RETRIES = 3
+
+    def __init__(self):
+        self.schedule = None
+        # set when edits couldn't be saved, memory no longer matches events.db
+        self.stale = False
+        self.data_version = None
+        self.lock = asyncio.Lock()
+        self.writes = asyncio.Queue()
+        self.writer = None
+        self.flushing = asyncio.Event()
+
+    def changed_externally(self):
+        # data_version only moves when another connection commits to the db
+        version = db_cur.execute("PRAGMA data_version").fetchone()[0]
+        changed = self.data_version is not None and version != self.data_version
+        self.data_version = version
+        return changed
+
+    async def load(self):
+        if self.schedule is not None and self.changed_externally():
+            print('events.db changed externally, reloading schedule')
+            await self.flush()
+            self.schedule = None
+        if self.stale:
+            print('reloading schedule after failed writes')
+            await self.flush()
+            self.schedule = None
+            self.stale = False
+        if self.schedule is None:
+            self.schedule = await Schedule.parse_msg(None)
+            self.changed_externally()
+        return self.schedule
+
+    async def get(self):
+        async with self.lock:
+            return await self.load()
+
+    @contextlib.asynccontextmanager
+    async def edit(self, change_reason: Optional[str]=None):
+        async with self.lock:
+            schedule = await self.load()
+            try:
+                yield schedule
+            finally:
+                if schedule.changes:
+                    changes, schedule.changes = schedule.changes, []
+                    self.writes.put_nowait((changes, change_reason))
+                    if self.writer is None or self.writer.done():
+                        self.writer = asyncio.create_task(self.write_behind())
+
+    async def write_behind(self):
+        while True:
+            batch = [await self.writes.get()]
+            if PUBLISH_DEBOUNCE and not self.flushing.is_set():
+                # let a burst of edits pile up and write it in one transaction
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.flushing.wait(), PUBLISH_DEBOUNCE)
+            while not self.writes.empty():
+                batch.append(self.writes.get_nowait())
+            try:
+                for attempt in range(ScheduleCache.WRITE_RETRIES + 1):
+                    try:
+                        for changes, change_reason in batch:
+                            persist_changes(self.schedule, changes, change_reason)
+                        db_con.commit()
+                        self.changed_externally()
+                        break
+                    except Exception as e:
+                        print(traceback.format_exc())
+                        print(f'persisting schedule failed: {e}')
+                        db_con.rollback()
+                        if attempt < ScheduleCache.WRITE_RETRIES:
+                            await asyncio.sleep(2 ** attempt)
+                else:
+                    print('giving up on the batch, the schedule will be reloaded from events.db')
+                    self.stale = True
+            finally:
+                for _ in batch:
+                    self.writes.task_done()
+
+    async def flush(self):
+        self.flushing.set()
+        try:
+            await self.writes.join()
+        finally:
+            self.flushing.clear()
+
+schedule_cache = ScheduleCache()
+
 async def send_announcement(ctx: discord.Interaction, event: Event):
     channel = client.get_channel(NEW_EVENTS)
     async with channel.typing():
         await channel.send(embed=event.make_embed(), allowed_mentions=discord.AllowedMentions.none())
 
 async def add_event(ctx: discord.Interaction, schedule_message: discord.Message, event: Event):
-    schedule = await Schedule.parse_msg(schedule_message)
-    schedule.add_event(event)
-    await set_events(schedule_message, schedule, change_reason=f'add event {event.name}')
+    async with schedule_cache.edit(change_reason=f'add event {event.name}') as schedule:
+        schedule.add_event(event)
+    await set_events(schedule_message, schedule)
     await send_announcement(ctx, event)
 
+async def add_events(ctx: discord.Interaction, schedule_message: discord.Message, events: List[Event]):
+    async with schedule_cache.edit(change_reason=f'add events {", ".join(e.name for e in events)}') as schedule:
+        for event in events:
+            schedule.add_event(event)
+    await set_events(schedule_message, schedule)
+    for event in events:
+        await send_announcement(ctx, event)
+
 async def clear_events(ctx: discord.Interaction, schedule_message: discord.Message):
-    await set_events(schedule_message, Schedule([]), change_reason='explicit clear')
+    async with schedule_cache.edit(change_reason='explicit clear') as schedule:
+        schedule.clear()
+    await set_events(schedule_message, schedule)
 
 def not_admin(message: discord.Message):
     return message.author.id != ADMIN_ID
 
-async def set_events(schedule_message: discord.Message, schedule: Schedule, change_reason: Optional[str]=None):
-    js = schedule.dump_json()
-    data = [(js, change_reason if change_reason else '')]
-    db_cur.executemany("INSERT INTO events_log(json, change) VALUES(?, ?);", data)
+# one row per message currently holding a rendered block of the schedule, in channel order
+PublishedPost = namedtuple('PublishedPost', ['message_id', 'kind', 'digest'])
+
+def post_kind(embeds):
+    return 'text' if embeds is None else 'embeds'
+
+def post_digest(content: str, embeds: Optional[List[discord.Embed]]):
+    rendered = [content, None if embeds is None else [e.to_dict() for e in embeds]]
+    return hashlib.sha1(json.dumps(rendered, sort_keys=True, default=json_default).encode()).hexdigest()
+
+def load_published_posts(channel_id: int):
+    res = db_cur.execute("SELECT message_id, kind, digest FROM schedule_messages WHERE channel_id = ? ORDER BY position", (channel_id,))
+    return [PublishedPost(*row) for row in res.fetchall()]
+
+def store_published_posts(channel_id: int, published: List[PublishedPost]):
+    db_cur.execute("DELETE FROM schedule_messages WHERE channel_id = ?", (channel_id,))
+    data = [(channel_id, position, p.message_id, p.kind, p.digest) for position, p in enumerate(published)]
+    db_cur.executemany("INSERT INTO schedule_messages(channel_id, position, message_id, kind, digest) VALUES(?, ?, ?, ?, ?);", data)
     db_con.commit()
-    posts = schedule.format_post()
-    embeds, texts = posts
-    pinned_message_content, *other_messages = embeds
-    # js_file = discord.File(io.BytesIO(js.encode()), spoiler=True, filename='schedule.json')
 
-    channel = schedule_message.channel
-    ctx = await get_webhook(channel)
-    async with channel.typing():
-        await channel.purge(check=not_admin)
-        sync = await ctx.send(content='.', wait=True)
-        msg = await ctx.send(
-            content=pinned_message_content[0],
-            ephemeral=False,
+async def send_post(ctx: discord.Webhook, throttle, content: str, embeds: Optional[List[discord.Embed]]):
+    await throttle()
+    if embeds is None:
+        return await ctx.send(
+            content=content,
+            suppress_embeds=True,
             wait=True,
-            embeds=pinned_message_content[1],
-            # suppress_embeds=True,
             silent=True,
             allowed_mentions=discord.AllowedMentions.none()
         )
-        await msg.pin()
-        await sync.delete(delay=1.0)
-        for m in other_messages:
-            await ctx.send(
-                content=m[0],
-                # suppress_embeds=True,
-                wait=True,
-                embeds=m[1],
-                silent=True,
-                allowed_mentions=discord.AllowedMentions.none()
-            )
-        for p in texts:
-            await ctx.send(
-                content=p,
-                suppress_embeds=True,
-                silent=True,
-                allowed_mentions=discord.AllowedMentions.none()
-            )
+    return await ctx.send(
+        content=content,
+        # suppress_embeds=True,
+        wait=True,
+        embeds=embeds,
+        silent=True,
+        allowed_mentions=discord.AllowedMentions.none()
+    )
+
+async def delete_posts(channel: discord.TextChannel, throttle, published: List[PublishedPost]):
+    # bulk delete only takes messages younger than two weeks, older ones go one by one
+    bulk_cutoff = discord.utils.utcnow() - datetime.timedelta(days=14) + datetime.timedelta(minutes=5)
+    recent = [discord.Object(p.message_id) for p in published if discord.utils.snowflake_time(p.message_id) > bulk_cutoff]
+    old = [p.message_id for p in published if discord.utils.snowflake_time(p.message_id) <= bulk_cutoff]
+    for i in range(0, len(recent), 100):
+        chunk = recent[i:i + 100]
+        try:
+            await throttle()
+            await channel.delete_messages(chunk)
+        except discord.NotFound:
+            old.extend(m.id for m in chunk)
+    for message_id in old:
+        with contextlib.suppress(discord.NotFound):
+            await throttle()
+            await channel.get_partial_message(message_id).delete()
+
+async def repost_posts(channel: discord.TextChannel, ctx: discord.Webhook, throttle, posts, stale: List[PublishedPost]):
+    await delete_posts(channel, throttle, stale)
+    await throttle()
+    sync = await ctx.send(content='.', wait=True)
+    published = []
+    for content, embeds in posts:
+        msg = await send_post(ctx, throttle, content, embeds)
+        published.append(PublishedPost(msg.id, post_kind(embeds), post_digest(content, embeds)))
+        if len(published) == 1:
+            await msg.pin()
+            await sync.delete(delay=1.0)
+    return published
+
+async def update_posts(channel: discord.TextChannel, ctx: discord.Webhook, throttle, published: List[PublishedPost], posts):
+    updated = []
+    # edit in place while the message at the same position can hold the block,
+    # a text post can't become an embed post (suppress flag), so from there on the tail is resent
+    for (content, embeds), old in zip(posts, published):
+        kind = post_kind(embeds)
+        if old.kind != kind:
+            break
+        digest = post_digest(content, embeds)
+        if old.digest != digest:
+            await throttle()
+            if embeds is None:
+                await ctx.edit_message(old.message_id, content=content, allowed_mentions=discord.AllowedMentions.none())
+            else:
+                await ctx.edit_message(old.message_id, content=content, embeds=embeds, allowed_mentions=discord.AllowedMentions.none())
+        updated.append(PublishedPost(old.message_id, kind, digest))
+
+    await delete_posts(channel, throttle, published[len(updated):])
+
+    for content, embeds in posts[len(updated):]:
+        msg = await send_post(ctx, throttle, content, embeds)
+        if not updated:
+            await msg.pin()
+        updated.append(PublishedPost(msg.id, post_kind(embeds), post_digest(content, embeds)))
+
+    return updated
+
+async def render_schedule(channel: discord.TextChannel, schedule: Schedule, throttle, purge: bool=False):
+    embeds, texts = schedule.format_post()
+    posts = embeds + [(p, None) for p in texts]
+    print(f'render cache: {render_cache.stats()}')
+    # js_file = discord.File(io.BytesIO(js.encode()), spoiler=True, filename='schedule.json')
+
+    ctx = await get_webhook(channel)
+    async with channel.typing():
+        published = load_published_posts(channel.id)
+        if purge or not published:
+            # recovery mode, or the first render in a channel whose old schedule messages were never tracked,
+            # walks the whole channel history
+            await channel.purge(check=not_admin)
+            published = []
+        try:
+            if published:
+                published = await update_posts(channel, ctx, throttle, published, posts)
+            else:
+                published = await repost_posts(channel, ctx, throttle, posts, [])
+        except discord.NotFound as e:
+            # someone removed one of our messages or the webhook, start from scratch
+            print(f'schedule messages out of sync, reposting: {e}')
+            channel_webhooks.pop(channel.id, None)
+            ctx = await get_webhook(channel)
+            published = await repost_posts(channel, ctx, throttle, posts, published)
+        store_published_posts(channel.id, published)
+
+class RateLimiter:
+    # at most rate calls in any per seconds, waiting before a call instead of running into a 429
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.calls = deque()
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self.calls and self.calls[0] <= now - self.per:
+                self.calls.popleft()
+            if len(self.calls) < self.rate:
+                self.calls.append(now)
+                return
+            await asyncio.sleep(self.calls[0] + self.per - now)
+
+class Publisher:
+    # one per channel, renders run one at a time and schedule changes queued
+    # while a render is in flight are coalesced into the next one
+    def __init__(self, channel: discord.TextChannel):
+        self.channel = channel
+        # webhook bucket and the per channel webhook message limit
+        self.limits = [RateLimiter(5, 2.0), RateLimiter(30, 60.0)]
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.last_render = None
+
+    async def throttle(self):
+        for limit in self.limits:
+            await limit.wait()
+
+    def publish(self, schedule: Schedule, purge: bool=False):
+        rendered = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((schedule, purge, rendered))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return rendered
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if PUBLISH_DEBOUNCE and self.last_render is not None:
+                # render at most once per window, whatever arrives meanwhile goes out with it
+                await asyncio.sleep(self.last_render + PUBLISH_DEBOUNCE - asyncio.get_running_loop().time())
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            schedule = batch[-1][0]
+            purge = any(purge for _, purge, _ in batch)
+            self.last_render = asyncio.get_running_loop().time()
+            try:
+                await render_schedule(self.channel, schedule, self.throttle, purge)
+                for _, _, rendered in batch:
+                    if not rendered.done():
+                        rendered.set_result(None)
+            except Exception as e:
+                for _, _, rendered in batch:
+                    if not rendered.done():
+                        rendered.set_exception(e)
+
+publishers = {}
+
+def publisher_for(channel: discord.TextChannel):
+    if channel.id not in publishers:
+        publishers[channel.id] = Publisher(channel)
+    return publishers[channel.id]
+
+def publish_failed(rendered: asyncio.Future):
+    if not rendered.cancelled() and rendered.exception() is not None:
+        print(''.join(traceback.format_exception(rendered.exception())))
+
+async def set_events(schedule_message: discord.Message, schedule: Schedule):
+    rendered = publisher_for(schedule_message.channel).publish(schedule)
+    if PUBLISH_DEBOUNCE:
+        # don't hold up the command, the publisher will get to it
+        rendered.add_done_callback(publish_failed)
+    else:
+        await rendered
 
 async def remove_event(ctx: discord.Interaction, schedule_message: discord.Message, event_value: str):
-    schedule = await Schedule.parse_msg(schedule_message)
-    schedule.remove_event(event_value)
-    await set_events(schedule_message, schedule, change_reason=f'remove event {event_value}')
+    async with schedule_cache.edit(change_reason=f'remove event {event_value}') as schedule:
+        schedule.remove_event(event_value)
+    await set_events(schedule_message, schedule)
 
 async def get_user_events(schedule_message: discord.Message, user: Optional[str]):
-    schedule = await Schedule.parse_msg(schedule_message)
+    schedule = await schedule_cache.get()
     user_events = filter(lambda e: (user is None or e.author == user) and e.active(), schedule.events)
     return list(user_events)
 
@@ -718,7 +1440,16 @@ class EventRemovalView(discord.ui.View):
     async def callback(self, ctx: discord.Interaction):
         await ctx.delete_original_response()
 
+# channel id -> pinned message / webhook, dropped on pin and webhook updates in the channel
+channel_pins = {}
+channel_webhooks = {}
+
 async def pinned_message_in_channel(channel: discord.TextChannel):
+    if channel.id not in channel_pins:
+        channel_pins[channel.id] = await fetch_pinned_message(channel)
+    return channel_pins[channel.id]
+
+async def fetch_pinned_message(channel: discord.TextChannel):
     pinned_messages = await channel.pins()
     pinned_message = None
     if not pinned_messages:
@@ -730,7 +1461,21 @@ async def pinned_message_in_channel(channel: discord.TextChannel):
 
     return pinned_message
 
-gcal = GCal()
+gcal = None
+gcal_lock = asyncio.Lock()
+
+async def get_gcal():
+    # the calendar client is only set up once something needs it, off the event loop
+    # because without a usable token.json it waits for an interactive login
+    global gcal
+    async with gcal_lock:
+        if gcal is None:
+            gcal = await asyncio.get_running_loop().run_in_executor(None, GCal)
+            gcal.start()
+    return gcal
+
+def startup_report(stage: str):
+    print(f'startup: {stage} after {time.monotonic() - STARTED:.2f}s')
 
 def is_bot(ctx):
     return ctx.user.bot
@@ -738,20 +1483,21 @@ def is_bot(ctx):
 class EventGroup(app_commands.Group):
     def __init__(self):
         super().__init__(name='event')
-        self.gcal = gcal
-        self.fb = Fb(FB_ACCESS_TOKEN, driver())
+        pool = DriverPool(FB_DRIVERS, max_queue=FB_QUEUE, timeout=FB_TIMEOUT, max_pages=FB_DRIVER_PAGES,
+                          max_age=FB_DRIVER_MINUTES * 60, max_rss=FB_DRIVER_MEMORY * 2**20)
+        self.fb = Fb(FB_ACCESS_TOKEN, pool=pool, graph_first=FB_GRAPH_FIRST,
+                     cache=FbCache(FB_CACHE_DB, ttl=FB_CACHE_TTL, max_entries=FB_CACHE_SIZE),
+                     graph=GraphClient(FB_ACCESS_TOKEN, timeout=FB_HTTP_TIMEOUT, retries=FB_HTTP_RETRIES),
+                     scraper=PageScraper(timeout=FB_HTTP_TIMEOUT) if FB_HTTP_SCRAPE else None)
 
     @app_commands.command()
     @app_commands.checks.has_role(ADMIN_ROLE_ID)
     async def sync(self, ctx: discord.Interaction):
         """reserved for admin use"""
         await ctx.response.defer(ephemeral=True)
-        gcal_events = self.gcal.fetch_events()
         pinned_message = await pinned_message_in_channel(ctx.channel)
-        schedule = await Schedule.parse_msg(pinned_message)
-        events = [ Event.from_gcal_event(ev) for ev in gcal_events ]
         # print('creating schedule')
-        schedule = schedule.merge_gcal(events)
+        schedule = await sync_gcal('gcal sync')
         await set_events(pinned_message, schedule)
         followup = await ctx.followup.send(
             ephemeral=True,
@@ -772,6 +1518,19 @@ class EventGroup(app_commands.Group):
         )
         await followup.delete(delay=5.0)
 
+    @app_commands.command()
+    @app_commands.checks.has_role(ADMIN_ROLE_ID)
+    async def repost(self, ctx: discord.Interaction):
+        """reserved for admin use"""
+        await ctx.response.defer(ephemeral=True)
+        schedule = await schedule_cache.get()
+        await publisher_for(ctx.channel).publish(schedule, purge=True)
+        followup = await ctx.followup.send(
+            ephemeral=True,
+            content="event list reposted"
+        )
+        await followup.delete(delay=5.0)
+
     # @purge.error
     # @sync.error
     # async def purge_error(self, ctx: discord.Interaction, error):
@@ -801,17 +1560,72 @@ class EventGroup(app_commands.Group):
             view = EventRemovalView(EventRemovalSelector(user_events[:25], response))
             await ctx.edit_original_response(content='Choose an event to remove', view=view)
 
+    @app_commands.command()
+    @app_commands.describe(urls='FB event links separated by spaces or new lines')
+    @app_commands.describe(file='Text file with FB event links')
+    async def fb_bulk(self, ctx: discord.Interaction, urls: Optional[str], file: Optional[discord.Attachment]):
+        """Adds many events using FB event links"""
+        await ctx.response.defer(ephemeral=True)
+        followup = None
+        try:
+            text = urls if urls else ''
+            if file is not None:
+                text += '\n' + (await file.read()).decode(errors='ignore')
+            links = list(dict.fromkeys(re.findall(r'https?://\S+', text)))
+            if not links:
+                followup = await ctx.followup.send(ephemeral=True, content='no links found')
+                return
+
+            events = []
+            summary = []
+            for url, result in await self.fb.fetch_events(links):
+                if isinstance(result, FbException):
+                    summary.append(f'{url} - failed: {str(result)}')
+                elif isinstance(result, Exception):
+                    print(''.join(traceback.format_exception(result)))
+                    summary.append(f'{url} - failed, please inform the mods about the issue')
+                else:
+                    ev = Event.from_fbevent(result)
+                    if ev.date is None:
+                        summary.append(f'{url} - failed: no start time found')
+                    else:
+                        events.append(ev)
+                        summary.append(f'{url} - added')
+
+            if events:
+                pinned_message = await pinned_message_in_channel(ctx.channel)
+                await add_events(ctx, pinned_message, events)
+
+            content = '\n'.join(summary)
+            if len(content) > 2000:
+                content = content[:1997] + '...'
+            followup = await ctx.followup.send(ephemeral=True, content=content, suppress_embeds=True)
+        except Exception:
+            followup = await ctx.followup.send(
+                ephemeral=True,
+                content=f"your command has failed, please inform the mods about the issue"
+            )
+            raise
+        finally:
+            if followup:
+                await followup.delete(delay=60.0)
+
     @app_commands.command()
     async def fb(self, ctx: discord.Interaction, url: str):
         """Adds a new event using a FB event link"""
         await ctx.response.defer(ephemeral=True)
         followup = None
         try:
-            event = self.fb.event_url(url)
+            event = await self.fb.fetch_event(url)
             ev = Event.from_fbevent(event)
             pinned_message = await pinned_message_in_channel(ctx.channel)
             await add_event(ctx, pinned_message, ev)
             followup = await ctx.followup.send(content=f'thank you for adding {url}', ephemeral=True)
+        except FbException as e:
+            followup = await ctx.followup.send(
+                ephemeral=True,
+                content=f"your command was unsuccessful because of: {str(e)}"
+            )
         except Exception:
             followup = await ctx.followup.send(
                 ephemeral=True,
@@ -849,7 +1663,7 @@ class EventGroup(app_commands.Group):
                 'time': tz.localize(time_parsed).time()
             }
             event = Event.create(name, **args)
-            print(vars(event))
+            print(event)
             errors = event.validate()
             if errors is not None:
                 raise EventValidationException(errors)
@@ -879,10 +1693,21 @@ class EventGroup(app_commands.Group):
 intents = discord.Intents.default()
 intents.message_content = True
 
-client = discord.Client(intents=intents)
+class EventBot(discord.Client):
+    async def close(self):
+        await schedule_cache.flush()
+        await event_group.fb.close()
+        await super().close()
+
+client = EventBot(intents=intents)
 tree = app_commands.CommandTree(client)
 
 async def get_webhook(channel: discord.TextChannel):
+    if channel.id not in channel_webhooks:
+        channel_webhooks[channel.id] = await fetch_webhook(channel)
+    return channel_webhooks[channel.id]
+
+async def fetch_webhook(channel: discord.TextChannel):
     wh = await channel.webhooks()
 
     if not wh:
@@ -899,27 +1724,34 @@ async def update_task():
     async with channel.typing():
         pinned_message = await pinned_message_in_channel(channel)
 
-        schedule = await Schedule.parse_msg(pinned_message)
-        schedule.cleanup()
-
         try:
-            gcal_events = gcal.fetch_events()
-            events = [ Event.from_gcal_event(ev) for ev in gcal_events ]
-            schedule = schedule.merge_gcal(events)
+            schedule = await sync_gcal('update task', cleanup=True)
 
-            await set_events(pinned_message, schedule, change_reason='update task')
+            await set_events(pinned_message, schedule)
         finally:
             pass
 
 
 @client.event
 async def on_ready():
+    startup_report('connected')
     await tree.sync(guild=discord.Object(id=GUILD_ID))
+    startup_report('commands synced')
+    await schedule_cache.get()
+    startup_report('schedule loaded')
     if not update_task.is_running():
         print("starting update_task")
         update_task.start()
     print("Ready!")
 
+@client.event
+async def on_guild_channel_pins_update(channel: discord.abc.GuildChannel, last_pin: Optional[datetime.datetime]):
+    channel_pins.pop(channel.id, None)
+
+@client.event
+async def on_webhooks_update(channel: discord.abc.GuildChannel):
+    channel_webhooks.pop(channel.id, None)
+
 @client.event
 async def on_message(message: discord.Message):
     async def process_message(message):
@@ -951,8 +1783,10 @@ async def on_message(message: discord.Message):
         pass
 
 
-tree.add_command(EventGroup(), guild=discord.Object(id=GUILD_ID))
+event_group = EventGroup()
+tree.add_command(event_group, guild=discord.Object(id=GUILD_ID))
 
 
 if __name__ == "__main__":
+    startup_report('imported')
     client.run(OAUTH_TOKEN)
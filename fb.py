@@ -1,29 +1,231 @@
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.wait import WebDriverWait
+import aiohttp
+import asyncio
+import contextlib
 import json
-import requests
+import os
+import queue
 import datetime
 from dateutil import parser
+import html
+from html.parser import HTMLParser
 import re
+import sqlite3
+import threading
+import time
 import traceback
 import pytz
+from concurrent.futures import ThreadPoolExecutor
 
 
+GRAPH_URL = 'https://graph.facebook.com'
+GRAPH_EVENT_FIELDS = 'description,cover,start_time,place,name,id,interested_count,attending_count,ticket_uri'
+
 class FbException(Exception):
     pass
 
+# only the page text and the cover image url are read, so the bytes behind them needn't load
+BLOCKED_URLS = ['*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.svg', '*.ico',
+                '*.woff', '*.woff2', '*.ttf', '*.otf', '*.mp4', '*.webm', '*.m3u8', '*.mp3']
+
 def driver():
+    from selenium import webdriver
     options = webdriver.ChromeOptions()
     options.add_extension('extension.crx')
     options.add_argument('--headless=new')
+    options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
 
     drv = webdriver.Chrome(options=options)
-    drv.implicitly_wait(5)
+    drv.execute_cdp_cmd('Network.enable', {})
+    drv.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URLS})
 
     return drv
 
+def process_tree_rss(pid):
+    # resident memory of a process and all its descendants in bytes, read from /proc
+    children = {}
+    rss = {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # the command name may contain spaces, fields after it are space separated
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            with open(f'/proc/{entry}/statm') as f:
+                rss[int(entry)] = int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        total += rss.get(p, 0)
+        todo.extend(children.get(p, []))
+    return total
+
+class PooledDriver:
+    def __init__(self, driver):
+        self.driver = driver
+        self.started_at = time.monotonic()
+        self.pages = 0
+        self.rss = 0
+
+    def alive(self):
+        try:
+            return self.driver.execute_script('return 1') == 1
+        except Exception:
+            return False
+
+    def measure(self):
+        try:
+            self.rss = process_tree_rss(self.driver.service.process.pid)
+        except Exception:
+            self.rss = 0
+        return self.rss
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            print(f'closing browser failed: {e}')
+
+class DriverPool:
+    # selenium is blocking, so scrapes run on worker threads, each with its own chrome,
+    # started by the first scrape that needs it. browsers are replaced after max_pages scrapes,
+    # max_age seconds, when they stop responding, or when all of them together use more than max_rss bytes
+    def __init__(self, size=1, max_queue=4, timeout=60.0, factory=driver, max_pages=50, max_age=60 * 60, max_rss=None):
+        self.size = size
+        self.max_pending = size + max_queue
+        self.pending = 0
+        self.timeout = timeout
+        self.factory = factory
+        self.max_pages = max_pages
+        self.max_age = max_age
+        self.max_rss = max_rss
+        self.drivers = []
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='fb-driver')
+
+    def start_driver(self):
+        with self.lock:
+            if len(self.drivers) >= self.size:
+                return None
+            # reserve the slot while chrome starts
+            self.drivers.append(None)
+        try:
+            drv = self.factory()
+            drv.set_page_load_timeout(self.timeout)
+        except Exception as e:
+            with self.lock:
+                self.drivers.remove(None)
+            print(traceback.format_exc())
+            raise FbException(f'could not start the browser: {e}')
+        pooled = PooledDriver(drv)
+        with self.lock:
+            if None in self.drivers:
+                self.drivers[self.drivers.index(None)] = pooled
+                return pooled
+        # the pool was closed while chrome started
+        pooled.quit()
+        raise FbException('the browser pool is shut down')
+
+    def retire(self, pooled, reason):
+        print(f'restarting browser after {pooled.pages} pages: {reason}')
+        with self.lock:
+            if pooled not in self.drivers:
+                # already quit by close()
+                return
+            self.drivers.remove(pooled)
+        pooled.quit()
+
+    def worn_out(self, pooled):
+        if self.max_pages and pooled.pages >= self.max_pages:
+            return f'{pooled.pages} pages loaded'
+        if self.max_age and time.monotonic() - pooled.started_at >= self.max_age:
+            return 'too old'
+        if self.max_rss:
+            pooled.measure()
+            with self.lock:
+                total = sum(d.rss for d in self.drivers if d is not None)
+            if total > self.max_rss:
+                return f'browsers using {total // 2**20}MB'
+        return None
+
+    def acquire(self):
+        pooled = None
+        with contextlib.suppress(queue.Empty):
+            pooled = self.idle.get_nowait()
+        if pooled is None:
+            pooled = self.start_driver() or self.idle.get()
+        if not pooled.alive():
+            self.retire(pooled, 'not responding')
+            return self.acquire()
+        return pooled
+
+    def release(self, pooled):
+        if pooled not in self.drivers:
+            # quit by close() mid-scrape
+            return
+        pooled.pages += 1
+        reason = self.worn_out(pooled)
+        if reason:
+            self.retire(pooled, reason)
+        else:
+            self.idle.put(pooled)
+
+    def checkout(self, fn, *args):
+        pooled = self.acquire()
+        try:
+            try:
+                return fn(pooled.driver, *args)
+            except Exception:
+                if pooled.alive():
+                    raise
+                # chrome died under us, give the scrape one more go on a fresh one
+                self.retire(pooled, 'crashed')
+                pooled = None
+                pooled = self.acquire()
+                return fn(pooled.driver, *args)
+        finally:
+            if pooled is not None:
+                self.release(pooled)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        # busy browsers too, their scrapes fail and nothing is put back
+        with self.lock:
+            drivers, self.drivers = [d for d in self.drivers if d is not None], []
+        for pooled in drivers:
+            pooled.quit()
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            raise FbException('too many facebook events are being processed, try again in a minute')
+
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+        job = loop.run_in_executor(self.executor, self.checkout, fn, *args)
+        # a timed out scrape still holds its browser, it only stops counting once the thread is done with it
+        job.add_done_callback(self.job_done)
+        try:
+            return await asyncio.wait_for(asyncio.shield(job), self.timeout)
+        except asyncio.TimeoutError:
+            raise FbException(f'processing the facebook event took longer than {self.timeout}s')
+
+    def job_done(self, job):
+        self.pending -= 1
+        if not job.cancelled():
+            # retrieved so a scrape that failed after its caller gave up isn't reported as never retrieved
+            job.exception()
+
 class FbEvent:
+    # everything Event.from_fbevent uses that the html scrape could otherwise fill in
+    REQUIRED_FIELDS = ['name', 'start_time', 'location', 'description', 'cover_img_url', 'fb_url']
+
     def __init__(self, name, **kwargs):
         self.name = name
         # print(kwargs)
@@ -66,6 +268,9 @@ class FbEvent:
         del data['name']
         return cls(name, **data)
 
+    def complete(self):
+        return all(getattr(self, field, None) is not None for field in FbEvent.REQUIRED_FIELDS)
+
     @classmethod
     def merge(cls, json, html):
         if not json:
@@ -73,26 +278,292 @@ class FbEvent:
         if not html:
             return json
         
-        merged = vars(html)
-        merged.update(vars(json))
+        merged = dict(vars(html))
+        merged.update({k: v for k, v in vars(json).items() if v is not None})
         name = json.name
         del merged['name']
         merged['hydrated'] = True
         return cls(name, **merged)
 
+class FbCache:
+    # merged FbEvents by fb event id, served as is while younger than ttl seconds,
+    # only the max_entries most recently used ones are kept
+    def __init__(self, path='fb_cache.db', ttl=6 * 60 * 60, max_entries=500):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.con = sqlite3.connect(path)
+        self.con.execute("CREATE TABLE IF NOT EXISTS fb_events(event_id text PRIMARY KEY, url text, data text, fetched_at real, used_at real)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS fb_events_used_at ON fb_events(used_at)")
+        self.con.commit()
+
+    def get(self, event_id):
+        row = self.con.execute("SELECT data, fetched_at FROM fb_events WHERE event_id = ?", (event_id,)).fetchone()
+        if row is None:
+            return None, False
+        self.con.execute("UPDATE fb_events SET used_at = ? WHERE event_id = ?", (time.time(), event_id))
+        self.con.commit()
+
+        data, fetched_at = row
+        args = json.loads(data)
+        if args.get('start_time') is not None:
+            args['start_time'] = parser.parse(args['start_time'])
+        event = FbEvent.from_html(args)
+        return event, time.time() - fetched_at < self.ttl
+
+    def put(self, event_id, url, event):
+        now = time.time()
+        data = json.dumps(vars(event), default=lambda o: o.isoformat() if isinstance(o, datetime.datetime) else None)
+        self.con.execute("INSERT OR REPLACE INTO fb_events(event_id, url, data, fetched_at, used_at) VALUES(?, ?, ?, ?, ?)", (event_id, url, data, now, now))
+        self.con.execute("DELETE FROM fb_events WHERE event_id NOT IN (SELECT event_id FROM fb_events ORDER BY used_at DESC LIMIT ?)", (self.max_entries,))
+        self.con.commit()
+
+class GraphClient:
+    # graph api error codes meaning we're being throttled
+    RATE_LIMIT_CODES = {4, 17, 32, 613}
+    # the batch endpoint takes at most 50 requests
+    BATCH_SIZE = 50
+
+    def __init__(self, access_token, timeout=10.0, retries=3, backoff=1.0, connections=10):
+        self.access_token = access_token
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.connections = connections
+        self.session = None
+
+    def get_session(self):
+        # created lazily, it has to be made inside the running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def throttled(self, data):
+        return isinstance(data, dict) and data.get('error', {}).get('code') in GraphClient.RATE_LIMIT_CODES
+
+    async def request(self, method, path='', params=None, data=None):
+        params = dict(params or {}, access_token=self.access_token)
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.get_session().request(method, f'{GRAPH_URL}/{path}', params=params, data=data) as response:
+                    body = await response.json(content_type=None)
+                    if response.status < 500 and response.status != 429 and not self.throttled(body):
+                        return body
+                    error = f'{response.status} {body}'
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = repr(e)
+
+            if attempt < self.retries:
+                delay = self.backoff * 2 ** attempt
+                print(f'graph api request failed: {error}, retrying in {delay}s')
+                await asyncio.sleep(delay)
+
+        raise FbException(f'graph api request failed: {error}')
+
+    async def event(self, event_id):
+        return await self.request('GET', event_id, params={'fields': GRAPH_EVENT_FIELDS})
+
+    async def events(self, event_ids):
+        results = {}
+        for i in range(0, len(event_ids), GraphClient.BATCH_SIZE):
+            chunk = event_ids[i:i + GraphClient.BATCH_SIZE]
+            batch = [{'method': 'GET', 'relative_url': f'{event_id}?fields={GRAPH_EVENT_FIELDS}'} for event_id in chunk]
+            responses = await self.request('POST', params={'include_headers': 'false'}, data={'batch': json.dumps(batch)})
+            if not isinstance(responses, list):
+                # the whole batch was rejected
+                responses = [{'body': json.dumps(responses)}] * len(chunk)
+
+            for event_id, response in zip(chunk, responses):
+                if response is None:
+                    results[event_id] = {'error': {'message': 'timed out in batch'}}
+                else:
+                    results[event_id] = json.loads(response['body'])
+        return results
+
+class EventPageParser(HTMLParser):
+    # collects <meta> tags and ld+json blocks, the rest of the page is skipped
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta = {}
+        self.ld_json = []
+        self.in_ld_json = False
+        self.chunks = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'meta':
+            key = attrs.get('property') or attrs.get('name')
+            if key and attrs.get('content') is not None:
+                self.meta.setdefault(key, attrs['content'])
+        elif tag == 'script' and attrs.get('type') == 'application/ld+json':
+            self.in_ld_json = True
+            self.chunks = []
+
+    def handle_data(self, data):
+        if self.in_ld_json:
+            self.chunks.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'script' and self.in_ld_json:
+            self.in_ld_json = False
+            try:
+                data = json.loads(''.join(self.chunks))
+            except ValueError:
+                return
+            self.ld_json.extend(data if isinstance(data, list) else [data])
+
+class PageScraper:
+    # reads the server rendered event page without a browser, returns None when
+    # the page doesn't carry enough to build the event so chrome can take over
+    HEADERS = {
+        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+        'Accept-Language': 'en-GB,en;q=0.9',
+    }
+
+    def __init__(self, timeout=10.0, connections=10):
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.connections = connections
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, headers=PageScraper.HEADERS)
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def event(self, url):
+        try:
+            async with self.get_session().get(url) as response:
+                if response.status != 200:
+                    print(f'fb page {url} returned {response.status}')
+                    return None
+                page = await response.text(errors='replace')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f'fetching fb page {url} failed: {e}')
+            return None
+        return self.parse(page, url)
+
+    @staticmethod
+    def parse(page, url):
+        page_parser = EventPageParser()
+        page_parser.feed(page)
+        page_parser.close()
+        meta = page_parser.meta
+        ld = next((d for d in page_parser.ld_json if isinstance(d, dict) and d.get('@type') == 'Event'), {})
+
+        start_time = None
+        start = ld.get('startDate') or meta.get('event:start_time')
+        if start:
+            try:
+                start_time = parser.parse(start)
+            except (ValueError, OverflowError):
+                pass
+        if start_time is not None and start_time.tzinfo is None:
+            start_time = pytz.timezone('Europe/London').localize(start_time)
+
+        place = ld.get('location')
+        place = place[0] if isinstance(place, list) and place else place
+        location = city = None
+        if isinstance(place, dict):
+            location = place.get('name')
+            address = place.get('address')
+            if isinstance(address, dict):
+                city = address.get('addressLocality')
+        elif isinstance(place, str):
+            location = place
+
+        image = ld.get('image')
+        image = image[0] if isinstance(image, list) and image else image
+        if isinstance(image, dict):
+            image = image.get('url')
+
+        # script contents aren't entity decoded by the parser
+        name = html.unescape(ld['name']) if ld.get('name') else meta.get('og:title')
+        description = html.unescape(ld['description']) if ld.get('description') else meta.get('og:description')
+        if not name or start_time is None:
+            return None
+
+        args = {
+            'name': name,
+            'location': location,
+            'city': city,
+            'start_time': start_time,
+            'cover_img_url': image or meta.get('og:image'),
+            'description': description,
+            'fb_url': url
+        }
+        return FbEvent.from_html(args)
+
 class Fb:
-    def __init__(self, access_token=None, driver=None):
+    # longest wait for the event page to render, the scripts below run in the page
+    # with the same xpaths the scrape used to walk element by element
+    PAGE_WAIT = 10
+    PAGE_READY_JS = """
+        return document.evaluate("//span[contains(text(), 'UTC+0')]", document, null,
+                                 XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue !== null;
+    """
+    SEE_MORE_JS = """
+        const more = document.evaluate("//*[contains(text(),'See more')]", document, null,
+                                       XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+        if (more) more.click();
+        return more !== null;
+    """
+    EXTRACT_JS = """
+        const one = (xpath, ctx) => document.evaluate(xpath, ctx || document, null,
+                                                      XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+        const all = (xpath, ctx) => {
+            const found = document.evaluate(xpath, ctx, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+            return Array.from({length: found.snapshotLength}, (_, i) => found.snapshotItem(i));
+        };
+        const text = node => node ? node.innerText : null;
+
+        const main = one("//footer/preceding-sibling::div");
+        const details = main && one(".//*[contains(text(), 'Details')]", main);
+        const info = details ? all("./../../../../following-sibling::*", details) : [];
+        const time = one("//span[contains(text(), 'UTC+0')]");
+        const [name, location] = time ? all("./../following-sibling::*", time) : [];
+        const cover = one("//img[@data-imgperflogname='profileCoverPhoto']");
+        return JSON.stringify({
+            name: text(name),
+            location: text(location),
+            time: text(time),
+            description: info.length ? text(info[info.length - 1]) : null,
+            cover: cover ? cover.getAttribute('src') : null
+        });
+    """
+
+    def __init__(self, access_token=None, driver=None, pool=None, graph_first=False, cache=None, graph=None, scraper=None):
         self.access_token = access_token
+        # tried before chrome, which only runs when the plain page didn't have the event
+        self.scraper = scraper
+        self.graph = graph if graph is not None or not access_token else GraphClient(access_token)
         self.driver = driver
+        self.pool = pool
+        self.cache = cache
+        # skip the browser when the graph api already returned everything we need
+        self.graph_first = graph_first
 
-    def json_event(self, event_id):
-        if not self.access_token:
-            raise FbException('access_token not specified')
+    @staticmethod
+    def event_id(url):
+        fb_event_pattern = r"facebook.com/events/"
+        event_match = re.search(fb_event_pattern, url)
+        event_id_match = re.search(r"\/(\d+)\/?\??[^\?]*$", url)
 
-        url = f'https://graph.facebook.com/{event_id}?access_token={self.access_token}&fields=description,cover,start_time,place,name,id,interested_count,attending_count,ticket_uri'
-        response = requests.get(url)
-        event_data = response.json()
+        if event_match and event_id_match:
+            return event_id_match.group(1)
+        else:
+            raise FbException(f'{url} is not a fb event url')
 
+    def parse_json_event(self, event_data):
         if 'error' in event_data:
             print(f'json error: {event_data}')
             return None
@@ -101,91 +572,172 @@ class Fb:
 
             return event
 
-    def html_event(self, event_url):
-        if not self.driver:
-            raise FbException('driver not specified')
+    async def json_event(self, event_id):
+        if not self.graph:
+            raise FbException('access_token not specified')
 
-        self.driver.get(event_url)
-        height = self.driver.execute_script('return document.body.parentNode.scrollHeight')
-        self.driver.set_window_size(910, height)
+        event_data = await self.graph.event(event_id)
+        return self.parse_json_event(event_data)
 
-        try:
-            more = self.driver.find_element(By.XPATH, '//*[contains(text(),\'See more\')]')
-            more.click()
-        except:
-            pass
+    async def json_events(self, event_ids):
+        if not self.graph:
+            raise FbException('access_token not specified')
 
-        main_div = self.driver.find_element(By.XPATH, '//footer/preceding-sibling::div')
-        deets = main_div.find_element(By.XPATH, './/*[contains(text(), \'Details\')]')
+        events_data = await self.graph.events(event_ids)
+        return {event_id: self.parse_json_event(data) for event_id, data in events_data.items()}
 
-        event_info = deets.find_elements(By.XPATH, './../../../../following-sibling::*')
+    def html_event(self, event_url, driver=None):
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.support.wait import WebDriverWait
+        driver = driver if driver is not None else self.driver
+        if not driver:
+            raise FbException('driver not specified')
 
-        *info, description = event_info
+        driver.get(event_url)
+        try:
+            WebDriverWait(driver, Fb.PAGE_WAIT, poll_frequency=0.2).until(lambda d: d.execute_script(Fb.PAGE_READY_JS))
+        except TimeoutException:
+            raise FbException(f'{event_url} did not load in {Fb.PAGE_WAIT}s')
+        height = driver.execute_script('return document.body.parentNode.scrollHeight')
+        driver.set_window_size(910, height)
+
+        driver.execute_script(Fb.SEE_MORE_JS)
+        data = json.loads(driver.execute_script(Fb.EXTRACT_JS))
+        if data['name'] is None:
+            raise FbException(f'could not find the event details on {event_url}')
 
-        dtime = self.driver.find_element(By.XPATH, '//span[contains(text(), \'UTC+0\')]')
         start_dtime = None
         try:
-            start_time, end_time = dtime.text.split(' – ', 1)
+            start_time, end_time = data['time'].split(' – ', 1)
             start_dtime = parser.parse(start_time)
         except:
             pass
         try:
-            start_time, rest = dtime.text.split('-', 1)
+            start_time, rest = data['time'].split('-', 1)
             start_dtime = parser.parse(start_time.replace('FROM ',''))
         except:
             pass
 
-        name, location, *rest = dtime.find_elements(By.XPATH, './../following-sibling::*')
-
-        cover_img = None
-        try:
-            img = self.driver.find_element(By.XPATH, '//img[@data-imgperflogname=\'profileCoverPhoto\']')
-            cover_img = img.get_attribute('src')
-        except:
-            pass
-
         tz = pytz.timezone('Europe/London')
         
         args = {
-            'name': name.text,
-            'location': location.text,
+            'name': data['name'],
+            'location': data['location'],
             'start_time': tz.localize(start_dtime) if start_dtime else None,
-            'cover_img_url': cover_img,
-            'description': description.text,
+            'cover_img_url': data['cover'],
+            'description': data['description'],
             'fb_url': event_url
         }
         event = FbEvent.from_html(args)
 
         return event
 
-    def event_url(self, url):
-        fb_event_pattern = r"facebook.com/events/"
-        event_match = re.search(fb_event_pattern, url)
-        event_id_match = re.search(r"\/(\d+)\/?\??[^\?]*$", url)
+    async def fetch_html(self, url):
+        if self.scraper is not None:
+            event = await self.scraper.event(url)
+            if event is not None:
+                return event
 
-        if event_match and event_id_match:
-            event_id = event_id_match.group(1)
-            json_event = None
-            html_event = None
+        if self.pool is None:
+            raise FbException('driver pool not specified')
 
+        return await self.pool.run(lambda drv: self.html_event(url, drv))
+
+    async def fetch_events(self, urls):
+        # the graph data for every url not served from the cache comes from one batch request,
+        # the chrome scrapes run alongside it on the driver pool
+        event_ids = []
+        for url in urls:
             try:
-                json_event = self.json_event(event_id)
+                event_id = self.event_id(url)
             except FbException:
-                pass
-            except Exception as e:
-                print(traceback.format_exc())
-                print(f'getting fb json exception: {e}')
+                continue
+            cached, fresh = self.cache.get(event_id) if self.cache is not None else (None, False)
+            if cached is None or not fresh:
+                event_ids.append(event_id)
+
+        json_batch = None
+        if self.graph and event_ids:
+            json_batch = asyncio.ensure_future(self.json_events(list(dict.fromkeys(event_ids))))
+
+        # at most one scrape per browser at a time, the rest wait here instead of overflowing the pool's queue
+        limit = asyncio.Semaphore(self.pool.size if self.pool is not None else len(urls) or 1)
+
+        async def limited(url):
+            async with limit:
+                return await self.fetch_event(url, json_batch)
+
+        results = await asyncio.gather(*(limited(url) for url in urls), return_exceptions=True)
+        if json_batch is not None and json_batch.done() and not json_batch.cancelled():
+            # retrieved so a failed batch isn't reported as never awaited
+            json_batch.exception()
+        return list(zip(urls, results))
 
+    async def fetch_event(self, url, json_batch=None):
+        event_id = self.event_id(url)
+        cached = None
+        if self.cache is not None:
+            cached, fresh = self.cache.get(event_id)
+            if cached is not None and fresh:
+                return cached
+
+        try:
+            event = await self.fetch_event_uncached(event_id, url, json_batch)
+        except FbException:
+            if cached is None:
+                raise
+            event = None
+
+        if event is None:
+            if cached is not None:
+                print(f'refreshing fb event {event_id} failed, using the cached copy')
+                return cached
+            raise FbException(f'could not get the event details from {url}')
+
+        if self.cache is not None:
+            self.cache.put(event_id, url, event)
+        return event
+
+    async def fetch_event_uncached(self, event_id, url, json_batch=None):
+        errors = []
+
+        async def json_source():
+            if json_batch is not None:
+                batch = await json_batch
+                if event_id in batch:
+                    return batch[event_id]
+            # left out of the batch because it was cached then, and the cache entry has gone stale or been evicted since
+            return await self.json_event(event_id)
+
+        async def guarded(source, job):
             try:
-                html_event = self.html_event(url)
-            except FbException:
-                pass
+                return await job
+            except FbException as e:
+                errors.append(str(e))
             except Exception as e:
                 print(traceback.format_exc())
-                print(f'getting fb html exception: {e}')
-            
-            event = FbEvent.merge(json_event, html_event)
-            return event
-                
+                print(f'getting fb {source} exception: {e}')
+
+        if self.graph_first:
+            json_event = await guarded('json', json_source())
+            if json_event is not None and json_event.complete():
+                return json_event
+            html_event = await guarded('html', self.fetch_html(url))
         else:
-            raise Exception(f'{url} is not a fb event url')
\ No newline at end of file
+            json_event, html_event = await asyncio.gather(
+                guarded('json', json_source()),
+                guarded('html', self.fetch_html(url))
+            )
+
+        event = FbEvent.merge(json_event, html_event)
+        if event is None and errors:
+            raise FbException(', '.join(errors))
+        return event
+
+    async def close(self):
+        if self.graph is not None:
+            await self.graph.close()
+        if self.scraper is not None:
+            await self.scraper.close()
+        if self.pool is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.pool.close)